@@ -1,50 +1,134 @@
 #!/usr/bin/env python3
-import sys, subprocess, os, importlib.util, shutil, glob
-import itertools, re, time, datetime, argparse
+# Only modules needed on every run are imported here.
+# Everything else is imported where it is used, so that runs which never reach that code do not pay to import it.
+import sys, subprocess, os, re, functools
+
+# Directory of previously compiled module objects, named by the hash of their source, flags, and compiler
+COMPILE_CACHE_DIR = os.path.join( os.path.expanduser( "~" ), ".cache", "eample_jit" )
+
+# Compiled pattern matching every newline that does not end the string
+@functools.lru_cache( maxsize=16 )
+def _indent_pattern( newline ):
+  return re.compile( f"{re.escape(newline)}(?!$)" )
+
 
 def indentstr( string, depth=1, indent="  ", split_on="\n", newline="\n", first_line=True, trailing_line=False ):
   indentation = indent*depth
-  indented_string = ""
-  indented_string += indentation if first_line else ""
-  indented_string += re.sub( f"{newline}(?!$)", f"{newline}{indentation}", string )
-  indented_string += indentation if trailing_line else ""
-  return indented_string
+  return "".join( [
+    indentation if first_line else "",
+    _indent_pattern( newline ).sub( f"{newline}{indentation}", string ),
+    indentation if trailing_line else ""
+  ] )
+
+
+# Module specification for a module object file, shared by every ModuleLoader importing that file
+@functools.lru_cache( maxsize=None )
+def _cached_spec( name, path ):
+  import importlib.util
+  return importlib.util.spec_from_file_location( name, path )
+
+
+# Modules already executed by hot_import, by module object path, inode, and modification time
+_imported_modules = {}
+
+
+# Hard link destination to source, which only adds a directory entry, or copy source to destination if they cannot be linked
+# (e.g. they are on different file systems, or the file system does not support hard links)
+#  Note: Linked files share contents *and* metadata, so neither may be modified in place afterwards (not even their timestamps).
+#        Module objects and compile cache entries are only ever replaced (removed, then created anew), never modified.
+def link_or_copy( source, destination ):
+  try:
+    os.link( source, destination )
+  except OSError:
+    import shutil
+    shutil.copy2( source, destination )
+
+
+# Working directory when this script was loaded, so that making paths absolute does not ask the OS for it every time
+_CWD = os.getcwd()
 
 
-# Like listdir, but with absolute paths
+# Like os.path.abspath, but relative to _CWD
+#  Note: Paths are relative to the working directory when this script was loaded, even if it has since changed.
+def abspath( path ):
+  return os.path.normpath( path if os.path.isabs( path ) else os.path.join( _CWD, path ) )
+
+
+# Like listdir, but with absolute paths, and generated lazily (directory entries are only read as they are needed)
 def listabsdir( dir ):
-  return [ os.path.abspath( os.path.join( dir, dir_rel_file_path) ) for dir_rel_file_path in os.listdir( dir ) ]
+  with os.scandir( dir ) as entries:
+    for entry in entries:
+      yield abspath( entry.path )
 
 
 class ModuleLoader:
-  def __init__(self, name, source_dir, install_dir=None, clean_on_context_exit=True, verbose=False):
+  # Python specific compilation flags, shared by all ModuleLoaders. None until first requested.
+  _cflags = None
+  # Compiler command and environment, shared by all ModuleLoaders. None until first requested.
+  _compiler = None
+  # Compiler version output, shared by all ModuleLoaders. None until first requested.
+  _compiler_version = None
+  # Running compiler version check, while one is running. None otherwise.
+  _compiler_version_process = None
+
+  def __init__(self, name, source_dir, install_dir=None, clean_on_context_exit=True, verbose=False, defer_cleanup=False, remove_created_parents=False):
     self.verbose = verbose
 
     self.name = name
-    self.source_dir = os.path.abspath( source_dir )
+    self.source_dir = abspath( source_dir )
     # Directory where module object will be stored
-    self.install_dir = os.path.abspath( install_dir if install_dir != None else os.path.join( os.getcwd(), "install" ) )
+    self.install_dir = abspath( install_dir if install_dir != None else os.path.join( _CWD, "install" ) )
+    # Full path to module source
+    self.source_path = f"{self.source_dir}{os.sep}{name}.c"
     # Full path to module object
-    self.module_object_path = os.path.join( self.install_dir, f"{name}.so" )
+    self.module_object_path = f"{self.install_dir}{os.sep}{name}.so"
 
     # None if module has not been previously built, self.install_dir otherwise
-    # Immediately check for existing module object
-    self.existing_install = self.module_object_path if os.path.isfile( self.module_object_path ) else None
+    # Immediately check for existing module object that is up to date with the source
+    self.existing_install = self.module_object_path if self._is_fresh() else None
     # None if module has not been imported, module namespace for this module otherwise
     self.existing_import = None
 
-    # Files and directories to be removed on clean
-    self.remove = []
+    # Manifest of files and directories to be removed on clean
+    # True if this ModuleLoader created the install directory, False otherwise
+    self.created_install_dir = False
+    # Outermost directory created along with the install directory (which may be the install directory itself), None if none was created
+    self.created_install_root = None
+    # True if this ModuleLoader created the module object, False otherwise
+    self.created_module_object = False
+    # True if cleanup() should also remove the empty parent directories created along with the install directory, False otherwise
+    self.remove_created_parents = remove_created_parents
     # For use with the context manager
     # True if cleanup() should occur when exiting the context manager, False otherwise
     self.clean_on_context_exit = clean_on_context_exit
+    # True if cleanup() should wait until the interpreter exits to remove files, False if it should remove them immediately.
+    # Deferring keeps the module object available to later ModuleLoaders for the same module in this process.
+    self.defer_cleanup = defer_cleanup
+    # True if deferred cleanup has been registered to run at exit, False otherwise
+    self.cleanup_deferred = False
 
     if self.verbose and self.existing_install:
       print( f"Detected previous object file {self.existing_install}" )
 
 
+  # True if the module object exists and is at least as new as its source (like make), False otherwise
+  def _is_fresh(self):
+    if not os.path.isfile( self.module_object_path ):
+      return False
+    try:
+      source_mtime = os.stat( self.source_path ).st_mtime
+    # Without source there is nothing to rebuild from, so the module object cannot be out of date
+    except FileNotFoundError:
+      return True
+    return os.stat( self.module_object_path ).st_mtime >= source_mtime
+
+
   # load the module. Build and import if necessary, use existing if available
   def load(self):
+    # Module object may have been built (e.g. by another ModuleLoader) since this one was created
+    if self.existing_install == None and self._is_fresh():
+      self.existing_install = self.module_object_path
+
     if self.existing_install == None:
       if self.verbose:
         print( "No pre-existing build." )
@@ -62,8 +146,171 @@ class ModuleLoader:
     return self.existing_import
 
 
-  # Build source into shared object
-  def build(self):
+  # Get proper python specific compilation flags.
+  # Read from the running interpreter's configuration rather than running python3-config,
+  # and only once, since they cannot change while the interpreter is running.
+  #  Note: Includes the flags for compiling shared library code (i.e. -fPIC), which python3-config --cflags omits.
+  @classmethod
+  def python_cflags(cls):
+    if cls._cflags == None:
+      import sysconfig
+      # Split on whitespace, exactly as python3-config itself does
+      cls._cflags = ( sysconfig.get_config_var( "CFLAGS" ) or "" ).split() \
+                  + ( sysconfig.get_config_var( "CCSHARED" ) or "" ).split() \
+                  + [ "-I" + sysconfig.get_path( "include" ) ]
+    return cls._cflags
+
+
+  # Get the compiler command and the environment to run it in (None to inherit this process's environment).
+  # Compile through ccache when it is available, so that unchanged source skips compilation across cache directories and machines.
+  # Keying ccache on the compiler's content (not its mtime) keeps its entries valid when the toolchain is reinstalled.
+  @classmethod
+  def compiler(cls):
+    if cls._compiler == None:
+      import shutil
+      if shutil.which( "ccache" ):
+        environment = dict( os.environ )
+        environment.setdefault( "CCACHE_COMPILERCHECK", "content" )
+        cls._compiler = ( [ "ccache", "gcc" ], environment )
+      else:
+        cls._compiler = ( [ "gcc" ], None )
+    return cls._compiler
+
+
+  # Path in the compile cache of the saved version string of the compiler currently on PATH, or None if it is not on PATH.
+  # Named by the compiler's path and modification time, which change whenever a different compiler is found or it is reinstalled.
+  @classmethod
+  def compiler_version_cache_path(cls):
+    import shutil, hashlib
+    compiler_path = shutil.which( "gcc" )
+    if compiler_path == None:
+      return None
+    compiler_hash = hashlib.sha256( f"{compiler_path}:{os.stat( compiler_path ).st_mtime_ns}".encode( "utf-8" ) ).hexdigest()
+    return os.path.join( COMPILE_CACHE_DIR, f"compiler-version-{compiler_hash}" )
+
+
+  # Start checking the compiler version in the background, unless it is already known or being checked,
+  # so that the check overlaps with other build preparation instead of delaying it.
+  # Uses the version saved by an earlier run if there is one, instead of running the compiler.
+  @classmethod
+  def start_compiler_version_check(cls):
+    if cls._compiler_version == None and cls._compiler_version_process == None:
+      version_cache_path = cls.compiler_version_cache_path()
+      if version_cache_path != None and os.path.isfile( version_cache_path ):
+        with open( version_cache_path, "rb" ) as version_file:
+          cls._compiler_version = version_file.read()
+      else:
+        cls._compiler_version_process = subprocess.Popen( ["gcc", "--version"], stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+
+
+  # Stop a compiler version check that is no longer needed (e.g. because the build failed before using it), so it is not left running.
+  @classmethod
+  def abandon_compiler_version_check(cls):
+    process = cls._compiler_version_process
+    if process != None:
+      cls._compiler_version_process = None
+      process.kill()
+      process.communicate()
+
+
+  # Get the compiler's version string, which identifies the compiler in the compile cache.
+  # Only checked once per run, like the compilation flags, and saved in the compile cache for later runs.
+  # The check is only reported if verbose.
+  @classmethod
+  def compiler_version( cls, verbose=False ):
+    cls.start_compiler_version_check()
+    if cls._compiler_version == None:
+      import tempfile
+      if verbose:
+        print( "Checking compiler version" )
+      process = cls._compiler_version_process
+      cls._compiler_version_process = None
+      stdout, stderr = process.communicate()
+      cls._compiler_version = cls.check_process( subprocess.CompletedProcess( process.args, process.returncode, stdout, stderr ), verbose ).stdout
+
+      # Like module objects, written to a temporary file and renamed into place, and not an error if it cannot be saved.
+      temp_path = None
+      try:
+        version_cache_path = cls.compiler_version_cache_path()
+        if version_cache_path != None:
+          os.makedirs( COMPILE_CACHE_DIR, exist_ok=True )
+          temp_file, temp_path = tempfile.mkstemp( suffix=".tmp", dir=COMPILE_CACHE_DIR )
+          with os.fdopen( temp_file, "wb" ) as version_file:
+            version_file.write( cls._compiler_version )
+          os.replace( temp_path, version_cache_path )
+      except OSError as error:
+        if verbose:
+          print( f"Could not cache compiler version: {error}" )
+        if temp_path != None and os.path.exists( temp_path ):
+          os.remove( temp_path )
+    return cls._compiler_version
+
+
+  # Simple wrapper to make sure exit code was successful, or raise error if it was not.
+  # Reports the execution if verbose.
+  @staticmethod
+  def check_process( completed_process, verbose=False, vaid_statuses=set([0]) ):
+    # Output is only decoded when it is reported, which is never for successful quiet builds
+    if completed_process.returncode in vaid_statuses and not verbose:
+      return completed_process
+    status = "successful" if completed_process.returncode in vaid_statuses else "failed"
+    report_str = f"Execution of {' '.join( completed_process.args )} {status} with status {completed_process.returncode}."
+    # Output that was not captured has already been shown as the process ran
+    if completed_process.stdout != None or completed_process.stderr != None:
+      stdout = ( completed_process.stdout or b"" ).decode('utf-8')
+      stderr = ( completed_process.stderr or b"" ).decode('utf-8')
+      report_str += "\n" + indentstr( f"stdout:\n{indentstr(stdout)}\nstderr:\n{indentstr(stderr)}" )
+    if completed_process.returncode not in vaid_statuses:
+      # raise RuntimeError( f"Execution of {' '.join( completed_process.args )} failed with status {completed_process.returncode}\n" + indentstr( f"stdout:\n{indentstr(stdout)}\nstderr:\n{indentstr(stderr)}" ) )
+      raise RuntimeError( report_str )
+    if verbose:
+      sep = "-"*80
+      print( f"{sep}\n{report_str}\n{sep}" )
+    return completed_process
+
+
+  # Run a build command, raising an error if it fails.
+  # When verbose, the command writes straight to this process's stdout and stderr as it runs.
+  # Otherwise its output goes to temporary files, which are only read if it fails.
+  def run_build_command( self, command, environment=None, cwd=None ):
+    if self.verbose:
+      # Anything already printed must come out before the command's own output
+      sys.stdout.flush()
+      sys.stderr.flush()
+      return self.check_process( subprocess.run( command, env=environment, cwd=cwd ), self.verbose )
+
+    import tempfile
+    with tempfile.TemporaryFile() as stdout_file, tempfile.TemporaryFile() as stderr_file:
+      completed_process = subprocess.run( command, stdout=stdout_file, stderr=stderr_file, env=environment, cwd=cwd )
+      if completed_process.returncode != 0:
+        stdout_file.seek( 0 )
+        stderr_file.seek( 0 )
+        completed_process.stdout = stdout_file.read()
+        completed_process.stderr = stderr_file.read()
+      return self.check_process( completed_process, self.verbose )
+
+
+  # Print a compiler command, with each source and flag on its own line
+  def print_command( self, description, command ):
+    compiler, _ = self.compiler()
+    # Command may be run by the compiler alone, without ccache
+    if command[:len(compiler)] != compiler:
+      compiler = command[:1]
+    lines = [ description, "\n", " ".join( compiler ) ]
+    sources=True # Source(s) come immediately after the command, so can print non flag parts (i.e. strings that do not begin with "-") as source until first flag
+    for part in command[len(compiler):]:
+      # flags and sources should go on newline (with continuing slash) and be indented
+      flag = part.startswith( "-" )
+      sources = sources and not flag # End source mode when flag appears
+      # arguments to flags go on same line
+      lines.append( f" \\\n  {part}" if sources or flag else f" {part}" )
+    # Written all at once, rather than part by part
+    sys.stdout.write( "".join( lines ) + "\n" )
+
+
+  # Make sure the install directory exists, creating it if it does not.
+  # Also removes any previous module object, since it is about to be replaced.
+  def prepare_install(self):
     # Does install location exist and is it a directory?
     if os.path.exists( self.install_dir ):
       # Path does exist (which is fine) but is not a directory (which is not fine)
@@ -75,110 +322,301 @@ class ModuleLoader:
     else:
       if self.verbose:
         print( f"Creating {self.install_dir}" )
+      # Walked by stripping path components, so must be normalized (e.g. no trailing separator)
+      created_install_root = os.path.normpath( self.install_dir )
+      while not os.path.exists( os.path.dirname( created_install_root ) ):
+        created_install_root = os.path.dirname( created_install_root )
       os.makedirs( self.install_dir )
-      self.remove.append( self.install_dir )
-
-    # Simple wrapper to make sure exit code was successful, or raise error if it was not.
-    def check_build( completed_process, vaid_statuses=set([0]) ):
-      stdout = completed_process.stdout.decode('utf-8')
-      stderr = completed_process.stderr.decode('utf-8')
-      status = "successful" if completed_process.returncode in vaid_statuses else "failed"
-      report_str = f"Execution of {' '.join( completed_process.args )} {status} with status {completed_process.returncode}.\n" + indentstr( f"stdout:\n{indentstr(stdout)}\nstderr:\n{indentstr(stderr)}" )
-      if completed_process.returncode not in vaid_statuses:
-        # raise RuntimeError( f"Execution of {' '.join( completed_process.args )} failed with status {completed_process.returncode}\n" + indentstr( f"stdout:\n{indentstr(stdout)}\nstderr:\n{indentstr(stderr)}" ) )
-        raise RuntimeError( report_str )
-      if self.verbose:
-        sep = "-"*80
-        print( f"{sep}\n{report_str}\n{sep}" )
-      return completed_process
+      self.created_install_dir = True
+      self.created_install_root = created_install_root
+
+    # Never write through (or otherwise modify) an existing module object, which may be a hard link into the compile cache
+    if os.path.lexists( self.module_object_path ):
+      os.remove( self.module_object_path )
+
+
+  # Path in the compile cache of the module object built from the current source.
+  # Identical source compiled with identical flags by the identical compiler produces an identical module object.
+  def cache_path(self):
+    import hashlib
+    with open( self.source_path, "rb" ) as source_file:
+      source = source_file.read()
+    source_hash = hashlib.sha256( b"\0".join( [ source, " ".join( self.python_cflags() ).encode( "utf-8" ), self.compiler_version( self.verbose ) ] ) ).hexdigest()
+    return os.path.join( COMPILE_CACHE_DIR, f"{source_hash}.so" )
+
+
+  # Install module object from the compile cache if it is there.
+  # Returns True if installed from the cache, False otherwise.
+  def install_from_cache( self, cache_path ):
+    if not os.path.isfile( cache_path ):
+      return False
 
-    # Call python3 config to get proper python specific compilation flags
     if self.verbose:
-      print( "Checking Python configuration cflags" )
-    python3_config_completed_process = check_build( subprocess.run( ["python3-config", "--cflags"], stdout=subprocess.PIPE, stderr=subprocess.PIPE ) )
+      print( f"Using cached module object {cache_path}" )
+    # The source may have been touched since the cache entry was made, leaving the entry older than it.
+    # Touching a link to the entry would touch the entry and every other install linked to it, marking them all up to date,
+    # so instead install a copy, which is newer than the source.
+    if os.stat( cache_path ).st_mtime >= os.stat( self.source_path ).st_mtime:
+      link_or_copy( cache_path, self.module_object_path )
+    else:
+      import shutil
+      shutil.copy( cache_path, self.module_object_path )
+
+    self.created_module_object = True
+    return True
+
+
+  # Save module object in the compile cache for later builds.
+  # Hard linked into the cache when possible, which is never partial, so the cache never holds a partial module object.
+  # Otherwise copied to a temporary file first and renamed into place for the same reason.
+  # The cache is only an optimization, so failing to populate it is not an error.
+  def save_to_cache( self, cache_path ):
+    temp_path = None
+    try:
+      os.makedirs( COMPILE_CACHE_DIR, exist_ok=True )
+      try:
+        os.link( self.module_object_path, cache_path )
+      # Already cached by another build, and being content-addressed, identical
+      except FileExistsError:
+        pass
+      except OSError:
+        import shutil, tempfile
+        temp_file, temp_path = tempfile.mkstemp( suffix=".so.tmp", dir=COMPILE_CACHE_DIR )
+        os.close( temp_file )
+        shutil.copy2( self.module_object_path, temp_path )
+        os.replace( temp_path, cache_path )
+      if self.verbose:
+        print( f"Cached module object as {cache_path}" )
+    except OSError as error:
+      if self.verbose:
+        print( f"Could not cache module object: {error}" )
+      if temp_path != None and os.path.exists( temp_path ):
+        os.remove( temp_path )
+
+
+  # Get ready to build source into shared object.
+  # Returns the path in the compile cache to save the built module object to,
+  # or None if there is nothing to compile, because the module object is up to date or was installed from the compile cache.
+  def prepare_build(self):
+    # Nothing to do if the module object is already up to date
+    if self._is_fresh():
+      if self.verbose:
+        print( f"Module object {self.module_object_path} is up to date" )
+      return None
+
+    self.start_compiler_version_check()
+    # The compiler version check is only finished by computing the cache path, so stop it if anything before then fails
+    try:
+      self.prepare_install()
+      cache_path = self.cache_path()
+    except Exception as exception:
+      self.abandon_compiler_version_check()
+      raise exception
+    if self.install_from_cache( cache_path ):
+      return None
+
+    return cache_path
+
+
+  # Build source into shared object
+  def build(self):
+    cache_path = self.prepare_build()
+    if cache_path == None:
+      return self.module_object_path
 
     # Setup build command
-    python3_flags = re.split( "\s+", python3_config_completed_process.stdout.decode("utf-8").strip() )
-    build_command = [ "gcc", os.path.join( self.source_dir, f"{self.name}.c" ), "-o", self.module_object_path, "--shared" ] + python3_flags
+    compiler, build_environment = self.compiler()
+    # ccache only caches compiling a single source into an object file, and passes anything else (like compiling and linking in one step) straight to the compiler.
+    # So when compiling through ccache, compile and link in separate steps, linking with the compiler alone.
+    if compiler[0] == "ccache":
+      import tempfile
+      with tempfile.TemporaryDirectory() as object_dir:
+        object_path = os.path.join( object_dir, f"{self.name}.o" )
+        compile_command = compiler + [ self.source_path, "-c", "-o", object_path ] + self.python_cflags()
+        link_command = compiler[-1:] + [ object_path, "-o", self.module_object_path, "--shared" ]
 
-    if self.verbose:
-      print( "Building Python C module using following command:" )
-      print( build_command[0], end="" )
-      sources=True # Source(s) come immediately after the command, so can print non flag parts (i.e. strings that do not begin with "-") as source until first flag
-      for part in build_command[1:]:
-        # flags and sources should go on newline (with continuing slash) and be indented
-        flag = part[0] == "-"
-        sources = sources and not flag # End source mode when flag appears
-        indent = sources or flag
-
-        if indent:
-          print( f" \\\n  {part}", end='' )
-        # arguments to flags go on same line
-        else:
-          print( f" {part}",  end='' )
-      print()
+        if self.verbose:
+          self.print_command( "Compiling Python C module using following command:", compile_command )
+        self.run_build_command( compile_command, build_environment )
 
-    # perform build
-    build_completed_process = check_build( subprocess.run( build_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE ) )
+        if self.verbose:
+          self.print_command( "Linking Python C module using following command:", link_command )
+        self.run_build_command( link_command, build_environment )
+
+    else:
+      build_command = compiler + [ self.source_path, "-o", self.module_object_path, "--shared" ] + self.python_cflags()
+
+      if self.verbose:
+        self.print_command( "Building Python C module using following command:", build_command )
 
-    self.remove.append( self.module_object_path )
+      # perform build
+      build_completed_process = self.run_build_command( build_command, build_environment )
+
+    self.created_module_object = True
 
     if self.verbose:
       print( "Build successful" )
 
+    self.save_to_cache( cache_path )
+
     return self.module_object_path
 
 
+  # Build the sources of many ModuleLoaders, compiling all sources in a single compiler invocation,
+  # instead of one compiler invocation per ModuleLoader.
+  # Module objects that are up to date or in the compile cache are not rebuilt.
+  # Each compiled source is then linked into its own module object, in parallel (unless reporting verbosely).
+  @classmethod
+  def build_many( cls, loaders ):
+    import concurrent.futures, tempfile
+
+    # Find the loaders that actually need compiling.
+    # Object files are named after their source, so sources with the same name must be compiled separately
+    batches = []
+    for loader in loaders:
+      cache_path = loader.prepare_build()
+      if cache_path == None:
+        loader.existing_install = loader.module_object_path
+        continue
+      batch = next( ( batch for batch in batches if all( other.name != loader.name for other, _ in batch ) ), None )
+      if batch == None:
+        batch = []
+        batches.append( batch )
+      batch.append( ( loader, cache_path ) )
+
+    # Compiled with the compiler alone, even when ccache is available, since ccache does not cache compiling more than one source at once
+    compiler, build_environment = cls.compiler()
+    compiler = compiler[-1:]
+    for batch in batches:
+      # The compiler writes each source's object file into its working directory
+      with tempfile.TemporaryDirectory() as object_dir:
+        # Reported verbosely if any loader in the batch is verbose
+        reporter = next( ( loader for loader, _ in batch if loader.verbose ), batch[0][0] )
+        compile_command = compiler + [ "-c" ] + [ loader.source_path for loader, _ in batch ] + cls.python_cflags()
+        if reporter.verbose:
+          reporter.print_command( "Compiling Python C modules using following command:", compile_command )
+        reporter.run_build_command( compile_command, build_environment, object_dir )
+
+        def link( loader_and_cache_path ):
+          loader, cache_path = loader_and_cache_path
+          link_command = compiler + [ os.path.join( object_dir, f"{loader.name}.o" ), "-o", loader.module_object_path, "--shared" ]
+          if loader.verbose:
+            loader.print_command( "Linking Python C module using following command:", link_command )
+          loader.run_build_command( link_command, build_environment )
+          loader.created_module_object = True
+          loader.existing_install = loader.module_object_path
+          if loader.verbose:
+            print( "Build successful" )
+          loader.save_to_cache( cache_path )
+
+        # Verbose links write straight to this process's output, so run them one at a time to keep their output apart
+        if reporter.verbose:
+          for loader_and_cache_path in batch:
+            link( loader_and_cache_path )
+        else:
+          with concurrent.futures.ThreadPoolExecutor( max_workers=os.cpu_count() ) as executor:
+            list( executor.map( link, batch ) )
+
+    return [ loader.module_object_path for loader in loaders ]
+
+
   # Import module as a module object and return it
   def hot_import(self):
+    import importlib.util
+
+    # The same module object file has already been loaded (e.g. by another ModuleLoader), so reuse that module
+    module_object_stat = os.stat( self.module_object_path )
+    key = ( self.module_object_path, module_object_stat.st_ino, module_object_stat.st_mtime_ns )
+    if key in _imported_modules:
+      if self.verbose:
+        print( f"Reusing module previously imported from {self.module_object_path}" )
+      return _imported_modules[key]
+
     # Load a module specification (or a 'spec') for a file path (much easier than trying to derive some import path)
     # Note: a module spec seems to be just an object that says where the module is, and some caching stuff.
-    spec = importlib.util.spec_from_file_location( self.name, self.module_object_path )
+    spec = _cached_spec( self.name, self.module_object_path )
     # 'Create' module from spec
     module = importlib.util.module_from_spec( spec )
     # Actually execute and load the module
     spec.loader.exec_module(module)
+    _imported_modules[key] = module
+    # Register like a regular import, so that later imports of this module's name find it
+    sys.modules[self.name] = module
     # Return the module object which can be used like a regular imported module
     return module
 
 
+  # Remove any files and directories created by the execution of this ModuleLoader, or if deferring cleanup, do so at exit
+  def cleanup(self):
+    if not self.defer_cleanup:
+      self.remove_created()
+    elif not self.cleanup_deferred:
+      import atexit
+      if self.verbose:
+        print( "Deferring cleanup until exit" )
+      atexit.register( self.remove_created )
+      self.cleanup_deferred = True
+
+
   # Remove any files and directories created by the execution of this ModuleLoader
   #  Note: Does *not* remove directories if they contain files *not* created by this ModuleLoader.
-  def cleanup(self):
-    # Sort in reverse to get things in bottom-up order.
-    # Mostly important to have the files inside a directory come before the directory itself.
-    self.remove.sort( reverse=True )
+  #  Note: Does *not* remove entries in the compile cache, only the module object linked or copied from it.
+  def remove_created(self):
+    if self.verbose and not ( self.created_module_object or self.created_install_dir ):
+      print( "No files to clean." )
 
-    if self.verbose:
-      if len(self.remove) > 0:
-        print( f"Removing files:\n" + indentstr( '\n'.join( self.remove ) ) )
-      else:
-        print( "No files to clean." )
+    # Remove the module object before the directory containing it
+    if self.created_module_object:
+      if self.verbose:
+        print( f"Removing {self.module_object_path}" )
+      try:
+        os.remove( self.module_object_path )
+      except FileNotFoundError:
+        if self.verbose:
+          print( f"  Path to \"{self.module_object_path}\" does not exist." )
+      self.created_module_object = False
 
-    for thing in self.remove:
+    # Make sure the install directory is empty before deleting.
+    # This is to ensure that no non-ModuleLoader files,
+    # which could be important, are not deleted
+    if self.created_install_dir:
       if self.verbose:
-        print( f"Removing {thing}" )
-      # If path is a directory, make sure it is empty before deleting.
-      # This is to ensure that no non-ModuleLoader files,
-      # which could be important, are not deleted
-      if os.path.isdir( thing ):
-          files = listabsdir( thing )
-          if len( files  ) > 0:
-            if self.verbose:
-              file_str = "\n".join( files )
-              print( f"  Cannot remove non-empty directory \"{thing}\". Contains:\n{indentstr(file_str)}" )
-            # skip and move on
-            continue
-          os.removedirs( thing )
-
-      # If this is a file (or link) simply remove.
-      elif os.path.isfile(thing):
-        os.remove( thing )
-
-      # Path does not exist
-      else:
+        print( f"Removing {self.install_dir}" )
+      try:
+        # Only the first entry is needed to tell, and the directory is closed as soon as it is read
+        with os.scandir( self.install_dir ) as entries:
+          empty = next( entries, None ) == None
+        if not empty:
+          if self.verbose:
+            file_str = "\n".join( listabsdir( self.install_dir ) )
+            print( f"  Cannot remove non-empty directory \"{self.install_dir}\". Contains:\n{indentstr(file_str)}" )
+        else:
+          os.rmdir( self.install_dir )
+          self.created_install_dir = False
+          if self.remove_created_parents:
+            self.remove_created_parent_dirs()
+      except FileNotFoundError:
         if self.verbose:
-          print( f"  Path to \"{thing}\" does not exist." )
+          print( f"  Path to \"{self.install_dir}\" does not exist." )
+        self.created_install_dir = False
+
+
+  # Remove the parents of the install directory that were created along with it, from the bottom up.
+  # Stops at the first that is not empty, since it (and so its parents) contain files not created by this ModuleLoader.
+  def remove_created_parent_dirs(self):
+    # Walked by stripping path components, so must be normalized (e.g. no trailing separator), like the root was
+    parent = os.path.normpath( self.install_dir )
+    while parent != self.created_install_root:
+      parent = os.path.dirname( parent )
+      if self.verbose:
+        print( f"Removing {parent}" )
+      try:
+        os.rmdir( parent )
+      except OSError as error:
+        if self.verbose:
+          print( f"  Cannot remove \"{parent}\": {error.strerror}" )
+        break
+    self.created_install_root = None
 
 
   # Upon entering a 'with ... as' block, load and return the module
@@ -202,15 +640,15 @@ class ModuleLoader:
       self.cleanup()
 
 
-def run_demo( name, source, bin, verbose, clean ):
+def run_demo( name, source, bin, verbose, clean, defer_clean=False ):
   # Manage module state with context manager, which loads/cleans on entry/exit
   print( "Using ModuleLoader context manager" )
-  with ModuleLoader( name, source, bin, clean, verbose ) as m:
+  with ModuleLoader( name, source, bin, clean, verbose, defer_clean ) as m:
     m.hello_world()
 
     # Specify my module, load, and cleanup explicitly
   print( "Explicitly invoking ModuleLoader API" )
-  my_module_loader = ModuleLoader( name, source, bin, clean, verbose )
+  my_module_loader = ModuleLoader( name, source, bin, clean, verbose, defer_clean )
   # Build and import, my_module is the module
   my_module = my_module_loader.load()
   # Call hello_world function in module
@@ -223,6 +661,8 @@ def run_demo( name, source, bin, verbose, clean ):
 
 
 def main( argv ):
+  import argparse
+
   # Path to script and its parent directory
   script_file = os.path.abspath( argv[0] )
   script_dir = os.path.dirname( script_file )
@@ -230,6 +670,7 @@ def main( argv ):
   parser = argparse.ArgumentParser( description="Demonstrate building and loading Python C module in runtime" )
   parser.add_argument( "-v", "--verbose",     help="Run with verbose output",                                                   action="store_true", default=False  )
   parser.add_argument( "-d", "--no-clean",    help="Do not clean created files on module exit",                                 action="store_true", default=False  )
+  parser.add_argument( "-e", "--defer-clean", help="Clean created files when the script exits, instead of on module exit",      action="store_true", default=False  )
   parser.add_argument( "-n", "--module-name", help="Name of module, and source file to compile",                                type=str,  nargs=1,  default="mymodule" )
   parser.add_argument( "-s", "--source",      help="Location of module source",                                                 type=str,  nargs=1,  default=os.path.join( script_dir, "src") )
   parser.add_argument( "-i", "--install",     help="Directory to install module object (will be created if it does not exist)", type=str,  nargs=1,  default=os.path.join( os.getcwd(), "bin") )
@@ -243,7 +684,7 @@ def main( argv ):
     for arg, value in args_dictionary.items():
       print( f"  {arg:>{max_len}}: {value}" )
 
-  run_demo( args.module_name, args.source, args.install, args.verbose, not args.no_clean  )
+  run_demo( args.module_name, args.source, args.install, args.verbose, not args.no_clean, args.defer_clean )
 
 
 if __name__ == "__main__":